@@ -12,13 +12,22 @@ __status__ = "Beta"
 # =============================================================================
 # Imports
 # =============================================================================
+import argparse
+import functools
+import hashlib
+import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import List
+from operator import attrgetter
+from typing import Dict, List, Set
 
 import filelock
 import yaml
@@ -30,16 +39,48 @@ import yaml
 # Regex to parse a datetime in format YYYY-MM-DD HH:mm:ss
 DATE_TIME_PATTERN = "\\d{4}-[0-1]\\d-[0-3]\\dT[0-2]\\d:[0-6]\\d:[0-6]\\d"
 
+# Regex to parse the name of a snapshot created by zfs_backup (<prefix>-<backup_type>-<datetime>)
+# (matches the raw bytes of the zfs list output)
+SNAP_RE = re.compile(rb"^.*@([a-z_]+)-([a-z_]+)-(" + DATE_TIME_PATTERN.encode("ascii") + rb")$")
+
+# Regex to parse a line of zpool get -H -p (<pool> <property> <value> <source>)
+ZPOOL_PROPERTY_RE = re.compile("^([^\\s]+)\\s+([^\\s]+)\\s+([^\\s]+)\\s+")
+
 # Format string for converting a datetime object into a string
 DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+# Use the libyaml based loader if PyYAML has been built with it
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Directory of the JSON cache of the parsed config files
+CONFIG_CACHE_DIR = "/var/cache/zfs_backup"
+
+# Header of the JSON cache of a config file
+CONFIG_CACHE_HEADER = "# content-version: {version}\n"
+
+# Default number of datasets that are backed up in parallel
+DEFAULT_PARALLELISM = 4
+
+# Default memory of all mbuffers between zfs send and zfs recv (1 GiB), shared by the parallel sends
+DEFAULT_SEND_BUFFER_BYTES = 1024 * 1024 * 1024
+
+# Block size of mbuffer, each pipeline needs a buffer of at least two blocks
+MBUFFER_BLOCK_BYTES = 128 * 1024
+
+# Regex for the options of the zfs send usage line, e.g. "send [-DLPbcehnpsVvw] [-i|-I snapshot] <snapshot>"
+ZFS_SEND_USAGE_PATTERN = "send \\[-([A-Za-z]+)\\]"
+
+# Path of the mbuffer executable, None if mbuffer is not installed
+MBUFFER = shutil.which("mbuffer")
+
 
 class Config:
 
     def __init__(self, pool: str, backup_pool: str, datasets: List[str], num_backups_daily: int,
                  num_backups_weekly: int,
                  num_backups_monthly: int, nums_backup_yearly: int, _log_file: str, _run_file: str, _mail_to: str,
-                 _prefix: str):
+                 _prefix: str, _parallelism: int = DEFAULT_PARALLELISM,
+                 _send_buffer_bytes: int = DEFAULT_SEND_BUFFER_BYTES, _compressed_send: bool = True):
         self.pool = pool
         self.backup_pool = backup_pool
         self.datasets = datasets
@@ -47,39 +88,40 @@ class Config:
         self.num_backups_weekly = num_backups_weekly
         self.num_backups_monthly = num_backups_monthly
         self.nums_backups_yearly = nums_backup_yearly
+        self._num_backups = {"daily": num_backups_daily,
+                             "weekly": num_backups_weekly,
+                             "monthly": num_backups_monthly,
+                             "yearly": nums_backup_yearly}
         self.log_file = _log_file
         self.run_file = _run_file
         self.mail_to = _mail_to
         self.prefix = _prefix
+        self.parallelism = _parallelism
+        self.send_buffer_bytes = _send_buffer_bytes
+        self.compressed_send = _compressed_send
+        self._source_snaps = None
+        self._backup_snaps = None
+        self._snaps_lock = threading.Lock()
+
+    def get_send_buffer_bytes_per_pipeline(self):
+        # send_buffer_bytes is the budget of all parallel sends
+        return self.send_buffer_bytes // self.parallelism
 
     def get_num_backups(self, _backup_type: str):
-        if _backup_type == "daily":
-            return self.num_backups_daily
-        if _backup_type == "weekly":
-            return self.num_backups_weekly
-        if _backup_type == "monthly":
-            return self.num_backups_monthly
-        if _backup_type == "yearly":
-            return self.nums_backups_yearly
-
-        logging.error("Unsupported backup type " + _backup_type)
-        exit(1)
+        # Returns None for an unsupported backup type
+        _num_backups = self._num_backups.get(_backup_type)
+        if _num_backups is None:
+            logging.error("Unsupported backup type %s", _backup_type)
+        return _num_backups
 
 
 class Diff:
     def __init__(self, l1, l2):
-        self.added = []
-        self.existing = []
-        self.removed = []
-        for e in l1:
-            if e not in l2:
-                self.removed.append(e)
-            else:
-                self.existing.append(e)
-
-        for e in l2:
-            if e not in l1:
-                self.added.append(e)
+        s1 = set(l1)
+        s2 = set(l2)
+        self.existing = [e for e in l1 if e in s2]
+        self.removed = [e for e in l1 if e not in s2]
+        self.added = [e for e in l2 if e not in s1]
 
 
 class Snapshot:
@@ -90,6 +132,10 @@ class Snapshot:
         self.backup_type = _backup_type
         self.backup_time = _backup_time
         self.prefix = _prefix
+        # The names never change, compute them once
+        self._snap_name = _prefix + "-" + _backup_type + "-" + _backup_time.strftime(DATE_TIME_FORMAT)
+        self._full_qualified_snap_name = _pool + "/" + _dataset + "@" + self._snap_name
+        self._full_qualified_backup_snap_name = _backup_pool + "/" + _dataset + "@" + self._snap_name
 
     def __repr__(self):
         return self.get_full_qualified_snap_name()
@@ -102,104 +148,179 @@ class Snapshot:
         return self.backup_pool + "/" + self.dataset
 
     def get_snap_name(self):
-        return self.prefix + "-" + self.backup_type + "-" + self.backup_time.strftime(DATE_TIME_FORMAT)
+        return self._snap_name
 
     def get_full_qualified_snap_name(self):
-        return self.pool + "/" + self.dataset + "@" + self.get_snap_name()
+        return self._full_qualified_snap_name
 
     def get_full_qualified_backup_snap_name(self):
-        return self.backup_pool + "/" + self.dataset + "@" + self.get_snap_name()
+        return self._full_qualified_backup_snap_name
 
-    def create(self, _last_snap=None):
+    def create(self, _config: Config, _last_snap=None):
 
-        logging.info("Creating snapshot " + self.get_full_qualified_backup_snap_name())
+        logging.info("Creating snapshot %s", self.get_full_qualified_backup_snap_name())
         zfs("snapshot", self.get_full_qualified_snap_name())
 
+        _send_cmd = ["zfs", "send"] + get_send_flags(_config.compressed_send)
         if _last_snap is None:
-            _cmd = ("zfs send '{new_snap}' | zfs recv -F '{backup_snap}'"
-                    .format(new_snap=self.get_full_qualified_snap_name(),
-                            backup_snap=self.get_full_qualified_backup_snap_name()))
+            _send_cmd += [self.get_full_qualified_snap_name()]
+            _recv_cmd = ["zfs", "recv", "-F", self.get_full_qualified_backup_snap_name()]
         else:
-            _cmd = ("zfs send -i '{last_snap}' '{new_snap}' | zfs recv -Fu '{backup_snap}'"
-                    .format(last_snap=_last_snap.get_full_qualified_snap_name(),
-                            new_snap=self.get_full_qualified_snap_name(),
-                            last_backup_snap=_last_snap.get_snap_name(),
-                            backup_snap=self.get_full_qualified_backup_snap_name()))
+            _send_cmd += ["-i", _last_snap.get_full_qualified_snap_name(), self.get_full_qualified_snap_name()]
+            _recv_cmd = ["zfs", "recv", "-Fu", self.get_full_qualified_backup_snap_name()]
+
+        run_send_pipeline(_send_cmd, _recv_cmd, _config.get_send_buffer_bytes_per_pipeline())
+
+
+def get_config_cache_file(_config_file):
+    _path_hash = hashlib.sha1(os.path.abspath(_config_file).encode("utf-8")).hexdigest()
+    return os.path.join(CONFIG_CACHE_DIR, _path_hash + ".json")
+
+
+def get_config_content_version(_config_file):
+    _stat = os.stat(_config_file)
+    _key = "{path}:{mtime}:{size}".format(path=os.path.abspath(_config_file), mtime=_stat.st_mtime_ns,
+                                          size=_stat.st_size)
+    return hashlib.sha1(_key.encode("utf-8")).hexdigest()
+
+
+def read_config_cache(_cache_file, _version):
+    # The cache is only an optimization, any problem with it falls back to parsing the YAML file
+    try:
+        with open(_cache_file) as _filehandle:
+            if _filehandle.readline() != CONFIG_CACHE_HEADER.format(version=_version):
+                return None
+            _c = json.load(_filehandle)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(_c, dict):
+        return None
+    return _c
 
-        logging.debug("Sending with " + _cmd)
-        res = subprocess.run(_cmd, shell=True)
-        if res.returncode != 0:
-            logging.error("Send failed: " + str(res.stderr))
-            exit(1)
+
+def write_config_cache(_cache_file, _version, _c):
+    _tmp_file = _cache_file + "." + str(os.getpid())
+    try:
+        os.makedirs(os.path.dirname(_cache_file), exist_ok=True)
+        with open(_tmp_file, "w") as _filehandle:
+            _filehandle.write(CONFIG_CACHE_HEADER.format(version=_version))
+            json.dump(_c, _filehandle)
+        os.replace(_tmp_file, _cache_file)
+    except (OSError, TypeError, ValueError):
+        try:
+            os.remove(_tmp_file)
+        except OSError:
+            pass
 
 
 def read_config(_config_file):
-    with open(_config_file) as _filehandle:
-        _c = yaml.safe_load(_filehandle)
+    _cache_file = get_config_cache_file(_config_file)
+    _version = get_config_content_version(_config_file)
+
+    # The cache contains the parsed YAML document, it is validated on every run so that
+    # changes of the validation and of the defaults apply to cached configs as well
+    _c = read_config_cache(_cache_file, _version)
+    if _c is None:
+        with open(_config_file) as _filehandle:
+            _c = yaml.load(_filehandle, Loader=_YamlLoader)
+        if isinstance(_c, dict):
+            write_config_cache(_cache_file, _version, _c)
+
+    return Config(**validate_config(_config_file, _c))
 
+
+def validate_config(_config_file, _c):
     if _c['dataPool'] is None:
-        logging.error("Missing dataPool in " + config_file)
+        logging.error("Missing dataPool in %s", _config_file)
         exit(1)
 
     if _c['datasets'] is None:
-        logging.error("Missing datasets in " + config_file)
+        logging.error("Missing datasets in %s", _config_file)
         exit(1)
 
     if _c['backupPool'] is None:
-        logging.error("Missing backupPool in " + config_file)
+        logging.error("Missing backupPool in %s", _config_file)
         exit(1)
 
     if _c['daily'] is None:
-        logging.error("Missing daily in " + config_file)
+        logging.error("Missing daily in %s", _config_file)
         exit(1)
     _daily = int(_c['daily'])
 
     if _c['weekly'] is None:
-        logging.error("Missing weekly in " + config_file)
+        logging.error("Missing weekly in %s", _config_file)
         exit(1)
     _weekly = int(_c['weekly'])
 
     if _c['monthly'] is None:
-        logging.error("Missing monthly in " + config_file)
+        logging.error("Missing monthly in %s", _config_file)
         exit(1)
     _monthly = int(_c['monthly'])
 
     if _c['yearly'] is None:
-        logging.error("Missing monthly in " + config_file)
+        logging.error("Missing yearly in %s", _config_file)
         exit(1)
     _yearly = int(_c['yearly'])
 
     if _c['logFile'] is None:
-        logging.error("Missing logFile in " + config_file)
+        logging.error("Missing logFile in %s", _config_file)
         exit(1)
     _logFile = _c['logFile']
 
     if _c['runFile'] is None:
-        logging.error("Missing runFile in " + config_file)
+        logging.error("Missing runFile in %s", _config_file)
         exit(1)
     _runFile = _c['runFile']
 
     if _c['prefix'] is None:
-        logging.error("Missing prefix in " + config_file)
+        logging.error("Missing prefix in %s", _config_file)
         exit(1)
     _prefix = _c['prefix']
 
     if _c['mailTo'] is None:
-        logging.error("Missing mailTo in " + config_file)
+        logging.error("Missing mailTo in %s", _config_file)
         exit(1)
     _mail_to = _c['mailTo']
 
-    return Config(pool=_c['dataPool'],
-                  backup_pool=_c['backupPool'],
-                  datasets=_c['datasets'],
-                  num_backups_daily=_daily,
-                  num_backups_weekly=_weekly,
-                  num_backups_monthly=_monthly,
-                  nums_backup_yearly=_yearly,
-                  _log_file=_logFile,
-                  _run_file=_runFile,
-                  _mail_to=_mail_to,
-                  _prefix=_prefix)
+    _parallelism = _c.get('parallelism')
+    if _parallelism is None:
+        _parallelism = DEFAULT_PARALLELISM
+    _parallelism = int(_parallelism)
+    if _parallelism < 1:
+        logging.error("Invalid parallelism in %s", _config_file)
+        exit(1)
+
+    _send_buffer_bytes = _c.get('sendBufferBytes')
+    if _send_buffer_bytes is None:
+        _send_buffer_bytes = DEFAULT_SEND_BUFFER_BYTES
+    _send_buffer_bytes = int(_send_buffer_bytes)
+    if _send_buffer_bytes // _parallelism < 2 * MBUFFER_BLOCK_BYTES:
+        logging.error("Invalid sendBufferBytes in %s (must be at least parallelism * %s)", _config_file,
+                      2 * MBUFFER_BLOCK_BYTES)
+        exit(1)
+
+    _compressed_send = _c.get('compressedSend')
+    if _compressed_send is None:
+        _compressed_send = True
+    if not isinstance(_compressed_send, bool):
+        logging.error("Invalid compressedSend in %s (must be true or false)", _config_file)
+        exit(1)
+
+    return dict(pool=_c['dataPool'],
+                backup_pool=_c['backupPool'],
+                datasets=_c['datasets'],
+                num_backups_daily=_daily,
+                num_backups_weekly=_weekly,
+                num_backups_monthly=_monthly,
+                nums_backup_yearly=_yearly,
+                _log_file=_logFile,
+                _run_file=_runFile,
+                _mail_to=_mail_to,
+                _prefix=_prefix,
+                _parallelism=_parallelism,
+                _send_buffer_bytes=_send_buffer_bytes,
+                _compressed_send=_compressed_send)
 
 
 def usage():
@@ -222,55 +343,152 @@ def usage():
 
 def zfs(*args):
     _c = ["zfs"] + list(args)
-    logging.debug("Executing " + str(_c))
-    _res = subprocess.run(["zfs"] + list(args), capture_output=True, shell=False)
-    logging.debug("return_code: " + str(_res.returncode))
+    logging.debug("Executing %s", _c)
+    _res = run_cmd(_c)
+    logging.debug("return_code: %s", _res.returncode)
     logging.debug("------- STDOUT ----------------")
     logging.debug(_res.stdout)
     logging.debug("------- STDERR ----------------")
     logging.debug(_res.stderr)
 
     if _res.returncode != 0:
-        logging.error("zfs " + str(args) + " failed: " + str(_res.stderr))
+        logging.error("zfs %s failed: %s", args, _res.stderr)
         exit(1)
 
 
 def zfs_destroy(_name):
     zfs("destroy", _name)
-    logging.info(_name + " deleted")
+    logging.info("%s deleted", _name)
 
 
-def zfs_send(_src, _target, _old=None):
-    if _old is None:
-        _cmd = "zfs send '" + _src + "' | zfs recv -F '" + _target + "'"
-    else:
-        _cmd = "zfs send -i '" + _old + "' '" + _src + "' | zfs recv -F '" + _target + "'"
+def destroy_snapshots(_snapshots: List[Snapshot], _backup_snap_names: Set[str]):
+    # zfs destroy accepts a comma separated list of snapshots of one dataset (<dataset>@<snap1>,<snap2>,...),
+    # all snapshots must belong to the same dataset
+    if len(_snapshots) == 0:
+        return
+    _snap_names = ",".join(_snapshot.get_snap_name() for _snapshot in _snapshots)
+    zfs_destroy(_snapshots[0].pool + "/" + _snapshots[0].dataset + "@" + _snap_names)
+
+    # Only destroy the snapshots that exist in the backup pool
+    _backup_names = ",".join(_snapshot.get_snap_name() for _snapshot in _snapshots
+                             if _snapshot.get_snap_name() in _backup_snap_names)
+    if len(_backup_names) > 0:
+        zfs_destroy(_snapshots[0].get_full_qualified_backup_dataset() + "@" + _backup_names)
+
+
+def get_send_flags(_compressed_send: bool) -> List[str]:
+    # -L large blocks, -c compressed blocks, -e embedded blocks: send the blocks as they are stored on disk
+    if _compressed_send:
+        return ["-Lce"]
+    return []
+
+
+def run_send_pipeline(_send_cmd: List[str], _recv_cmd: List[str], _send_buffer_bytes: int):
+    _cmds = [_send_cmd]
+    # Buffer the stream between zfs send and zfs recv if mbuffer is installed, the pipe buffer
+    # of the kernel is too small to keep both sides busy
+    if MBUFFER is not None:
+        _cmds.append([MBUFFER, "-q", "-s", str(MBUFFER_BLOCK_BYTES), "-m", str(_send_buffer_bytes)])
+    _cmds.append(_recv_cmd)
+
+    logging.debug("Sending with %s", _cmds)
+
+    _processes = []
+    _stdin = None
+    try:
+        for _i, _cmd in enumerate(_cmds):
+            _stdout = subprocess.PIPE if _i < len(_cmds) - 1 else None
+            _process = subprocess.Popen(_cmd, stdin=_stdin, stdout=_stdout)
+            if _stdin is not None:
+                # Only the next process of the pipeline reads from the pipe
+                _stdin.close()
+            _stdin = _process.stdout
+            _processes.append(_process)
+    except OSError as e:
+        logging.error("Send failed: %s can not be started: %s", _cmd, e)
+        if _stdin is not None:
+            _stdin.close()
+        for _process in _processes:
+            _process.kill()
+            _process.wait()
+        exit(1)
 
-    logging.debug("Executing: " + (str(_cmd)))
-    res = subprocess.run(_cmd, shell=True)
-    if res.returncode != 0:
-        logging.error("Send failed: " + str(res.stderr))
+    _failed = False
+    for _process in _processes:
+        if _process.wait() != 0:
+            logging.error("Send failed: %s exited with return code %s", _process.args, _process.returncode)
+            _failed = True
+
+    if _failed:
         exit(1)
 
 
-def get_snapshots(_config: Config, _dataset):
-    fqn = _config.pool + "/" + _dataset
+def zfs_supports_compressed_send():
+    # zfs send without arguments fails and prints the usage.
+    # Returns None if the usage can not be parsed (support is unknown).
+    _res = exec_cmd("zfs", "send")
+    result = re.search(ZFS_SEND_USAGE_PATTERN, _res.stderr.decode("utf-8", "replace")
+                       + _res.stdout.decode("utf-8", "replace"))
+    if result is None:
+        return None
+    return all(_flag in result.group(1) for _flag in "Lce")
 
-    _res = exec_cmd_and_exit_on_error("zfs", "list", "-t", "snapshot", "-H", "-o", "name", fqn)
 
-    regex = re.compile("^.*@([a-z_]+)-([a-z_]+)-(" + DATE_TIME_PATTERN + ")$")
+def zfs_send(_src, _target, _old=None, _send_buffer_bytes=DEFAULT_SEND_BUFFER_BYTES, _compressed_send=True):
+    _send_cmd = ["zfs", "send"] + get_send_flags(_compressed_send)
+    if _old is not None:
+        _send_cmd += ["-i", _old]
+    _send_cmd += [_src]
+
+    run_send_pipeline(_send_cmd, ["zfs", "recv", "-F", _target], _send_buffer_bytes)
+
+
+# Lists the snapshots of all datasets of the data pool and the backup pool with a single zfs call.
+# The results are cached in the config.
+def load_snapshots(_config: Config):
+    with _config._snaps_lock:
+        if _config._source_snaps is None:
+            _config._source_snaps, _config._backup_snaps = list_all_snapshots(_config)
+
+
+# Maps the dataset name (relative to the pool) to its snapshots in the data pool
+def get_all_snapshots(_config: Config) -> Dict[str, List[Snapshot]]:
+    load_snapshots(_config)
+    return _config._source_snaps
 
-    snaps = []
-    for line in _res.stdout.decode("utf-8").splitlines():
-        result = regex.match(line)
-        if result is not None:
-            _prefix = result.group(1)
-            _backup_type = result.group(2)
-            _backup_time = datetime.strptime(result.group(2), DATE_TIME_FORMAT)
-            snaps.append(
-                Snapshot(_config.pool, dataset, _config.backup_pool, _backup_type, _backup_time, _prefix))
 
-    return snaps
+# Maps the dataset name (relative to the pool) to the names of its snapshots in the backup pool
+def get_all_backup_snapshots(_config: Config) -> Dict[str, Set[str]]:
+    load_snapshots(_config)
+    return _config._backup_snaps
+
+
+def list_all_snapshots(_config: Config):
+    _res = exec_cmd_and_exit_on_error("zfs", "list", "-r", "-t", "snapshot", "-H", "-o", "name",
+                                      _config.pool, _config.backup_pool)
+
+    _pool_prefix = _config.pool.encode("utf-8") + b"/"
+    _backup_pool_prefix = _config.backup_pool.encode("utf-8") + b"/"
+    snaps = {}
+    backup_snaps = {}
+    for line in _res.stdout.splitlines():
+        result = SNAP_RE.match(line)
+        if result is None:
+            continue
+        _at = line.index(b"@")
+        if line.startswith(_pool_prefix):
+            _dataset = line[len(_pool_prefix):_at].decode("utf-8")
+            _prefix = result.group(1).decode("ascii")
+            _backup_type = result.group(2).decode("ascii")
+            # SNAP_RE guarantees an ISO 8601 timestamp, fromisoformat is much faster than strptime
+            _backup_time = datetime.fromisoformat(result.group(3).decode("ascii"))
+            snaps.setdefault(_dataset, []).append(
+                Snapshot(_config.pool, _dataset, _config.backup_pool, _backup_type, _backup_time, _prefix))
+        elif line.startswith(_backup_pool_prefix):
+            _dataset = line[len(_backup_pool_prefix):_at].decode("utf-8")
+            backup_snaps.setdefault(_dataset, set()).add(line[_at + 1:].decode("utf-8"))
+
+    return snaps, backup_snaps
 
 
 class ZPoolStatus:
@@ -281,54 +499,67 @@ class ZPoolStatus:
         self.capacity_in_percent = _capacity_in_percent
 
 
-def get_zpool_status(_pool_name: str) -> ZPoolStatus:
-    _res = exec_cmd("zpool", "get", "-H", "-p", "health,capacity", _pool_name)
-
-    _ret = ZPoolStatus(_pool_name)
-
-    if _res.returncode != 0:
-        return _ret
+# Queries the status of several pools with a single zpool call
+def get_zpool_statuses(_pool_names: List[str]) -> Dict[str, ZPoolStatus]:
+    _res = exec_cmd("zpool", "get", "-H", "-p", "health,capacity", *_pool_names)
 
-    _ret.available = True
-
-    regex = re.compile("^" + _pool_name + "\\s+([^\\s]+)\\s+([^\\s]+)\\s+")
+    _ret = {_pool_name: ZPoolStatus(_pool_name) for _pool_name in _pool_names}
 
+    # zpool get fails if one of the pools is not available, but still reports the available pools
     for line in _res.stdout.decode("utf-8").splitlines():
-        result = regex.match(line)
-        if result is not None:
-            _property_name = result.group(1)
-            _property_value = result.group(2)
+        result = ZPOOL_PROPERTY_RE.match(line)
+        if result is not None and result.group(1) in _ret:
+            _status = _ret[result.group(1)]
+            _status.available = True
+            _property_name = result.group(2)
+            _property_value = result.group(3)
             if _property_name == "health":
                 # Possible Values ONLINE, DEGRADED, FAULTED, OFFLINE, REMOVED, UNAVAIL
-                _ret.health = _property_value
+                _status.health = _property_value
             elif _property_name == "capacity":
-                _ret.capacity_in_percent = float(_property_value)
+                _status.capacity_in_percent = float(_property_value)
         else:
-            logging.debug("Line " + line + " does not match " + str(regex))
+            logging.debug("Line %s does not match %s", line, ZPOOL_PROPERTY_RE)
 
     return _ret
 
 
+def get_zpool_status(_pool_name: str) -> ZPoolStatus:
+    return get_zpool_statuses([_pool_name])[_pool_name]
+
+
 def zpool_import(_pool_name: str):
-    logging.info("Importing ZFS pool " + _pool_name)
+    logging.info("Importing ZFS pool %s", _pool_name)
     exec_cmd_and_exit_on_error("zpool", "import", _pool_name)
 
 
+@functools.lru_cache(maxsize=None)
+def find_executable(_name: str):
+    _path = shutil.which(_name)
+    if _path is None:
+        return _name
+    return _path
+
+
+def run_cmd(_cmd):
+    # subprocess can only use posix_spawn instead of fork/exec if the executable is given with its
+    # path and the file descriptors are not closed (all descriptors opened by python are not inheritable)
+    return subprocess.run([find_executable(_cmd[0])] + list(_cmd[1:]), capture_output=True, shell=False,
+                          close_fds=False)
+
+
 def exec_cmd_and_exit_on_error(*_cmd):
-    logging.debug("Running " + str(_cmd))
-    _res = subprocess.run(_cmd, capture_output=True, shell=False)
+    logging.debug("Running %s", _cmd)
+    _res = run_cmd(_cmd)
     _return_code = _res.returncode
-    logging.debug("return_code: " + str(_return_code))
+    logging.debug("return_code: %s", _return_code)
     logging.debug("------- STDOUT ----------------")
     logging.debug(_res.stdout)
     logging.debug("------- STDERR ----------------")
     logging.debug(_res.stderr)
 
-    _res = subprocess.run(_cmd, capture_output=True, shell=False)
-
     if _return_code != 0:
-        logging.error("Command [" + str(_cmd) + "] exited with return code " + str(_return_code)
-                      + "\n: stderr:" + str(_res.stderr))
+        logging.error("Command [%s] exited with return code %s\n: stderr:%s", _cmd, _return_code, _res.stderr)
         exit(1)
 
     return _res
@@ -336,9 +567,9 @@ def exec_cmd_and_exit_on_error(*_cmd):
 
 def exec_cmd(executable: str, *_args):
     _cmd = [executable] + list(_args)
-    logging.debug("Running " + str(_cmd))
-    _res = subprocess.run(_cmd, capture_output=True, shell=False)
-    logging.debug("return_code: " + str(_res.returncode))
+    logging.debug("Running %s", _cmd)
+    _res = run_cmd(_cmd)
+    logging.debug("return_code: %s", _res.returncode)
     logging.debug("------- STDOUT ----------------")
     logging.debug(_res.stdout)
     logging.debug("------- STDERR ----------------")
@@ -347,18 +578,16 @@ def exec_cmd(executable: str, *_args):
 
 
 def zpool_export(_pool_name: str):
-    logging.info("Exporting ZFS pool " + _pool_name)
+    logging.info("Exporting ZFS pool %s", _pool_name)
     exec_cmd_and_exit_on_error("zpool", "export", _pool_name)
 
 
-def backup(_config: Config, _dataset: str, _backup_type: str):
-    _num_backups_to_keep = _config.get_num_backups(_backup_type)
-
-    logging.info("Backup [{pool}]/{dataset}@{backup_type}] to {backup_pool} (num backups to keep={num_backups_to_keep})"
-                 .format(pool=_config.pool, dataset=_dataset, backup_type=_backup_type, backup_pool=_config.backup_pool,
-                         num_backups_to_keep=_num_backups_to_keep))
-
-    _poolStatus = get_zpool_status(_config.pool)
+# Checks the data pool and the backup pool, imports the backup pool if necessary.
+# Returns True if the backup pool has been imported.
+def check_pools(_config: Config) -> bool:
+    _statuses = get_zpool_statuses([_config.pool, _config.backup_pool])
+    _poolStatus = _statuses[_config.pool]
+    _backupPoolStatus = _statuses[_config.backup_pool]
 
     if not _poolStatus.available:
         zfs_backup_failed(_config, "zpool " + _config.pool + " is not available")
@@ -366,8 +595,6 @@ def backup(_config: Config, _dataset: str, _backup_type: str):
     if _poolStatus.health != "ONLINE":
         zfs_backup_failed(_config, "zpool " + _config.pool + " is not healthy (health=" + _poolStatus.health + ")")
 
-    _backupPoolStatus = get_zpool_status(_config.backup_pool)
-
     _backupPoolImport = False
 
     if not _backupPoolStatus.available:
@@ -384,46 +611,98 @@ def backup(_config: Config, _dataset: str, _backup_type: str):
         zfs_backup_warn(_config, "Low capacity " + str(_backupPoolStatus.capacity_in_percent)
                         + " in pool " + _backupPoolStatus.name)
 
-    _all_snapshots = get_snapshots(_config, _dataset)
+    return _backupPoolImport
+
+
+# Groups the datasets by their top level component. The groups can be backed up in parallel, the
+# datasets of a group are ordered parents first (zfs recv needs the parent in the backup pool).
+def group_datasets(_datasets: List[str]) -> List[List[str]]:
+    _groups = {}
+    for _dataset in _datasets:
+        _groups.setdefault(_dataset.split("/")[0], []).append(_dataset)
+    return [sorted(_group, key=lambda _d: _d.count("/")) for _group in _groups.values()]
+
+
+def backup_group(_config: Config, _datasets: List[str], _backup_type: str, _stop: threading.Event):
+    for _dataset in _datasets:
+        # Another group failed, do not start the backup of further datasets
+        if _stop.is_set():
+            return
+        try:
+            backup(_config, _dataset, _backup_type)
+        except BaseException:
+            # Set before the worker can pick up the next group (exit() raises SystemExit)
+            _stop.set()
+            raise
+
+
+def backup_datasets(_config: Config, _backup_type: str):
+    # Stops on the first failed group like a serial backup: groups that have not been started are
+    # cancelled and the running groups do not start further datasets
+    _stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=_config.parallelism) as _executor:
+        _futures = [_executor.submit(backup_group, _config, _datasets, _backup_type, _stop)
+                    for _datasets in group_datasets(_config.datasets)]
+        for _future in as_completed(_futures):
+            _exception = _future.exception()
+            if _exception is not None:
+                _executor.shutdown(cancel_futures=True)
+                raise _exception
 
-    sorted(_all_snapshots, key=lambda snapshot: snapshot.backup_time, reverse=True)
 
-    _snapshots = []
-    for snap in _all_snapshots:
-        if snap.backup_type == _backup_type:
-            _snapshots.append(snap)
+def backup(_config: Config, _dataset: str, _backup_type: str):
+    _num_backups_to_keep = _config.get_num_backups(_backup_type)
 
-    logging.info("Existing snapshots: " + str(_snapshots))
+    logging.info("Backup [%s]/%s@%s] to %s (num backups to keep=%s)",
+                 _config.pool, _dataset, _backup_type, _config.backup_pool, _num_backups_to_keep)
 
-    _last_snapshot = None
-    if len(_all_snapshots) > 0:
-        _last_snapshot = _all_snapshots[len(_all_snapshots) - 1]
-    logging.info("Last snapshots: " + str(_last_snapshot))
+    _all_snapshots = get_all_snapshots(_config).get(_dataset, [])
+    _backup_snap_names = get_all_backup_snapshots(_config).get(_dataset, set())
+
+    # Newest snapshot first
+    _all_snapshots.sort(key=attrgetter('backup_time'), reverse=True)
+
+    # Snapshots of the backup type, oldest first
+    _snapshots = deque(snap for snap in reversed(_all_snapshots) if snap.backup_type == _backup_type)
 
+    logging.info("Existing snapshots: %s", _snapshots)
+
+    _expired_snapshots = []
     while len(_snapshots) > _num_backups_to_keep - 1:
-        _snapshots.pop(0).destroy()
+        # The oldest snapshot is expired
+        _expired_snapshots.append(_snapshots.popleft())
 
-    if len(_snapshots) == 0:
-        new_snap = Snapshot(_config.pool, dataset, _config.backup_pool, _backup_type, datetime.now(), _config.prefix)
-        new_snap.create(_last_snapshot)
-    else:
-        new_snap = Snapshot(_config.pool, dataset, _config.backup_pool, _backup_type, datetime.now(), _config.prefix)
-        new_snap.create(_last_snapshot)
+    # The incremental send needs the last snapshot in both pools
+    _last_snapshot = None
+    for snap in _all_snapshots:
+        if snap.get_snap_name() in _backup_snap_names:
+            _last_snapshot = snap
+            break
+    logging.info("Last snapshots: %s", _last_snapshot)
+
+    # An expired last snapshot is destroyed after the send, it is the base of the incremental stream
+    destroy_snapshots([snap for snap in _expired_snapshots if snap is not _last_snapshot], _backup_snap_names)
+
+    new_snap = Snapshot(_config.pool, _dataset, _config.backup_pool, _backup_type, datetime.now(), _config.prefix)
+    new_snap.create(_config, _last_snapshot)
 
-    if _backupPoolImport:
-        zpool_export(_config.backup_pool)
+    destroy_snapshots([snap for snap in _expired_snapshots if snap is _last_snapshot], _backup_snap_names)
 
 
 def sendmail(_config: Config, body, subject):
     sendmail_location = "/usr/sbin/sendmail"  # sendmail location
-    p = os.popen("%s -t" % sendmail_location, "w")
-    p.write("To: %s\n" % "news@hierlmeier.de")
-    p.write("Subject: " + subject + "\n")
-    p.write("\n")  # blank line separating headers from body
-    p.write(body)
-    status = p.close()
-    if status != 0:
-        print("Sendmail exit status", status)
+    _msg = ("To: {to}\n"
+            "Subject: {subject}\n"
+            "\n"  # blank line separating headers from body
+            "{body}").format(to=_config.mail_to, subject=subject, body=body)
+    try:
+        p = subprocess.Popen([sendmail_location, "-t"], stdin=subprocess.PIPE)
+        p.communicate(_msg.encode("utf-8"))
+    except OSError as e:
+        logging.error("Sendmail failed: %s", e)
+        return
+    if p.returncode != 0:
+        logging.error("Sendmail exit status %s", p.returncode)
 
 
 def zfs_backup_failed(_config: Config, _msg: str):
@@ -444,43 +723,24 @@ def zfs_backup_warn(_config: Config, _msg: str):
 
 
 if __name__ == '__main__':
-    yesMode = 0
-    config_file = None
-    backup_type = None
-
-    log_level = logging.INFO
-    log_to_console = False
-
-    i = 1
-    while i < len(sys.argv):
-        arg = sys.argv[i]
-        if arg == "-h":
-            usage()
-            exit(0)
-        elif arg == "-s":
-            silent = 1
-        elif arg == "y":
-            yesMode = 1
-        elif arg == "-c":
-            i = i + 1
-            if i >= len(sys.argv):
-                logging.error("Missing <config_file> for -c")
-                exit(1)
-            config_file = sys.argv[i]
-        elif arg == '-b':
-            i = i + 1
-            if i >= len(sys.argv):
-                logging.error("Missing <backup> for -t")
-                exit(1)
-            backup_type = sys.argv[i]
-        elif arg == "--debug":
-            log_level = logging.DEBUG
-        elif arg == "--logToConsole":
-            log_to_console = True
-        else:
-            logging.error("Unknown option [" + arg + "]")
-            exit(1)
-        i = i + 1
+    _parser = argparse.ArgumentParser(add_help=False)
+    _parser.add_argument("-h", action="store_true", dest="help")
+    _parser.add_argument("-s", action="store_true", dest="silent")
+    _parser.add_argument("-y", action="store_true", dest="yes_mode")
+    _parser.add_argument("-c", dest="config_file")
+    _parser.add_argument("-b", dest="backup_type")
+    _parser.add_argument("--debug", action="store_true")
+    _parser.add_argument("--logToConsole", action="store_true", dest="log_to_console")
+    _args = _parser.parse_args()
+
+    if _args.help:
+        usage()
+        exit(0)
+
+    config_file = _args.config_file
+    backup_type = _args.backup_type
+    log_level = logging.DEBUG if _args.debug else logging.INFO
+    log_to_console = _args.log_to_console
 
     if config_file is None:
         logging.error("Missing option -c")
@@ -498,6 +758,9 @@ if __name__ == '__main__':
         logging.basicConfig(level=log_level, filename=config.log_file,
                             format='%(asctime)s | %(levelname)s | %(message)s')
 
+    if config.get_num_backups(backup_type) is None:
+        exit(1)
+
     _pid = os.getpid()
     _lock = filelock.FileLock(config.run_file)
 
@@ -507,8 +770,22 @@ if __name__ == '__main__':
 
         logging.info("Backup started (pid=%s, backup_type=%s) --------------------------------", _pid, backup_type)
 
-        for dataset in config.datasets:
-            backup(config, dataset, backup_type)
+        if config.compressed_send:
+            _compressed_send_supported = zfs_supports_compressed_send()
+            if _compressed_send_supported is None:
+                # Dropping -L would break the incremental receive of existing backups, keep the configured value
+                logging.warning("Can not parse the usage of zfs send, assuming -L, -c and -e are supported")
+            elif not _compressed_send_supported:
+                logging.warning("zfs send does not support -L, -c and -e, using uncompressed send")
+                config.compressed_send = False
+
+        _backup_pool_imported = check_pools(config)
+
+        try:
+            backup_datasets(config, backup_type)
+        finally:
+            if _backup_pool_imported:
+                zpool_export(config.backup_pool)
 
         with open(config.run_file, "w") as _f:
             _f.write("")